@@ -1,9 +1,22 @@
 import os
-import json
+import sys
+import math
+import asyncio
+import logging
+import logging.handlers
+import queue
+from collections import deque
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
+from time import time_ns
 import discord
-from discord.ext import tasks
 import aiohttp
+import orjson
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # ============================================================
 # CONFIGURATION
@@ -13,35 +26,98 @@ DISCORD_TOKEN    = os.environ.get('DISCORD_TOKEN')
 YOUR_DISCORD_ID  = int(os.environ.get('DISCORD_USER_ID', 0))
 FLIGHT_MINUTES   = 94
 LANDING_BUFFER   = 2   # Land 2min AFTER restock
-CHECK_INTERVAL   = 1
+MIN_POLL_SECONDS = 5
+POLL_SECONDS     = 60  # In stock, or sold out with no predicted restock yet
+MAX_POLL_SECONDS = 300 # Sold out, predicted restock more than 20min away
 WARNING_MINUTES  = 10
+CYCLE_PROCESS_SD = 2   # Minutes the true cycle duration may drift per cycle
+CYCLE_MEASURE_SD = 5   # Minutes of noise in an observed cycle (poll gaps, YATA lag)
+CYCLE_HISTORY    = 10  # Cycles kept for display/persistence
+FRESH_WAIT       = 3   # Seconds to wait for fresh data before serving the last good copy
+DM_RETRIES       = 3   # Retries for a DM that failed with a transient error (2s, 4s, 8s backoff)
 PROMETHEUS_URL   = 'https://api.prombot.co.uk/api/travel'
 YATA_URL         = 'https://yata.yt/api/v1/travel/export/'
+SHARK_FIN_ID     = 1485
+STATE_FILE       = os.environ.get('STATE_FILE', 'state.json')
+LOG_LEVEL        = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# (minutes before predicted restock, poll interval in seconds), closest first
+POLL_INTERVALS = (
+    (5,  30),
+    (20, 60),
+)
+
+# (name, url, provides nextRestock) in order of preference
+SOURCES = (
+    ('Prometheus', PROMETHEUS_URL, True),
+    ('YATA',       YATA_URL,       False),
+)
 
 TRAVEL_URL = "https://www.torn.com/page.php?sid=travel"
 
+FLIGHT_MS        = FLIGHT_MINUTES * 60 * 1000
+DEPART_OFFSET_MS = (FLIGHT_MINUTES - LANDING_BUFFER) * 60 * 1000
+WARN_OFFSET_MS   = WARNING_MINUTES * 60 * 1000
+CYCLE_PROCESS_VAR = (CYCLE_PROCESS_SD * 60 * 1000) ** 2
+CYCLE_MEASURE_VAR = (CYCLE_MEASURE_SD * 60 * 1000) ** 2
+
 # ============================================================
 # STATE - Self-calibrating with cycle tracking
 # ============================================================
 
-state = {
-    'quantity': None,
-    'last_depletion': None,
-    'last_restock': None,
-    'cycle_history': [],
-    'avg_cycle_duration': None,
-    'predicted_restock': None,
-    'prometheus_restock': None,
-    'warning_sent': False,
-    'depart_sent': False,
+@dataclass(slots=True)
+class State:
+    quantity: int | None = None
+    last_depletion: int | None = None
+    last_restock: int | None = None
+    cycle_history: deque = field(default_factory=lambda: deque(maxlen=CYCLE_HISTORY))
+    avg_cycle_duration: float | None = None
+    cycle_variance: float | None = None
+    predicted_restock: int | None = None
+    prometheus_restock: int | None = None
+    warning_sent: bool = False
+    depart_sent: bool = False
+
+STATE = State()
+
+# Fields restored on restart so a mid-cycle restart keeps its predictions,
+# with the types a well-formed state file may hold for each
+_NUMBER = (int, float, type(None))
+PERSISTED_FIELDS = {
+    'cycle_history': list,
+    'avg_cycle_duration': _NUMBER,
+    'cycle_variance': _NUMBER,
+    'predicted_restock': _NUMBER,
+    'prometheus_restock': _NUMBER,
+    'warning_sent': bool,
+    'depart_sent': bool,
 }
+_saved_state = None
+
+# Shared HTTP session, created in on_ready and reused by every poll
+SESSION = None
+
+# DM channel to YOUR_DISCORD_ID, resolved once on the first send
+DM_CHANNEL = None
+
+# Outgoing DMs, drained in order by dm_worker() so monitor() never waits on Discord
+_dm_queue = asyncio.Queue()
+_dm_worker_task = None
+
+# Background task running monitor_forever()
+_monitor_task = None
+
+# Stale-while-revalidate cache for get_data()
+_last_data = None
+_last_data_at = None
+_refresh_task = None
 
 # ============================================================
 # UTILITIES
 # ============================================================
 
 def now_ms():
-    return int(datetime.now(timezone.utc).timestamp() * 1000)
+    return time_ns() // 1_000_000
 
 def fmt(ms):
     s = abs(int(ms)) // 1000
@@ -54,52 +130,115 @@ def ts(ms):
     epoch = int(ms / 1000)
     return f"<t:{epoch}:T> (<t:{epoch}:R>)"
 
-def log(msg):
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}", flush=True)
+# Records are queued on the event loop thread and written to stderr by
+# log_listener's thread, so a slow stdout/journald pipe can't stall the loop.
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%H:%M:%S'))
+log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+logging.basicConfig(level=LOG_LEVEL, format='%(message)s', handlers=[logging.handlers.QueueHandler(_log_queue)])
+logger = logging.getLogger('sharkfin')
+log = logger.info
 
 def parse_iso(dt_str):
     if not dt_str:
         return None
+    # fromisoformat() accepts a trailing 'Z' natively from 3.11
+    if sys.version_info < (3, 11) and dt_str.endswith('Z'):
+        dt_str = dt_str[:-1] + '+00:00'
     try:
-        return int(datetime.fromisoformat(dt_str.replace('Z', '+00:00')).timestamp() * 1000)
-    except:
+        return int(datetime.fromisoformat(dt_str).timestamp() * 1000)
+    except (ValueError, TypeError):
         return None
 
+def _dump_state():
+    data = {name: getattr(STATE, name) for name in PERSISTED_FIELDS}
+    data['cycle_history'] = list(STATE.cycle_history)
+    return orjson.dumps(data)
+
+def load_state():
+    global _saved_state
+    try:
+        with open(STATE_FILE, 'rb') as f:
+            data = orjson.loads(f.read())
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        log(f"Could not load {STATE_FILE}: {e}")
+        return
+    if not isinstance(data, dict):
+        log(f"Could not load {STATE_FILE}: expected an object")
+        return
+    for name, types in PERSISTED_FIELDS.items():
+        if name not in data:
+            continue
+        if isinstance(data[name], types):
+            setattr(STATE, name, data[name])
+        else:
+            log(f"Ignoring {name} in {STATE_FILE}: unexpected {type(data[name]).__name__}")
+    STATE.cycle_history = deque(STATE.cycle_history, maxlen=CYCLE_HISTORY)
+    _saved_state = _dump_state()
+    log(f"💾 Restored state | cycles: {len(STATE.cycle_history)}")
+
+def _write_state(payload):
+    tmp = f"{STATE_FILE}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp, STATE_FILE)
+
+async def save_state():
+    global _saved_state
+    payload = _dump_state()
+    if payload == _saved_state:
+        return
+    try:
+        await asyncio.to_thread(_write_state, payload)
+        _saved_state = payload
+    except OSError as e:
+        log(f"Could not save {STATE_FILE}: {e}")
+
 def calc_depart_time(restock_ms):
-    return restock_ms - (FLIGHT_MINUTES * 60 * 1000) + (LANDING_BUFFER * 60 * 1000)
+    return restock_ms - DEPART_OFFSET_MS
+
+def calc_warn_time(restock_ms, dept_ms):
+    # Our own predictions warn earlier by one standard deviation of the cycle estimate
+    warn = dept_ms - WARN_OFFSET_MS
+    if restock_ms != STATE.prometheus_restock:
+        warn -= cycle_sd()
+    return warn
 
 def record_cycle(depletion_time, restock_time):
     duration = restock_time - depletion_time
-    state['cycle_history'].append({
+    STATE.cycle_history.append({
         'depletion': depletion_time,
         'restock': restock_time,
         'duration': duration
     })
 
-    if len(state['cycle_history']) > 10:
-        state['cycle_history'].pop(0)
+    # Scalar Kalman filter: avg_cycle_duration is the estimate, cycle_variance its variance
+    if STATE.avg_cycle_duration is None:
+        STATE.avg_cycle_duration = duration
+        STATE.cycle_variance = CYCLE_MEASURE_VAR
+    else:
+        var = (STATE.cycle_variance or CYCLE_MEASURE_VAR) + CYCLE_PROCESS_VAR
+        gain = var / (var + CYCLE_MEASURE_VAR)
+        STATE.avg_cycle_duration += gain * (duration - STATE.avg_cycle_duration)
+        STATE.cycle_variance = (1 - gain) * var
 
-    durations = [c['duration'] for c in state['cycle_history']]
-    state['avg_cycle_duration'] = sum(durations) / len(durations)
+    log(f"📊 Cycle recorded | duration: {fmt(duration)} | avg: {fmt(STATE.avg_cycle_duration)} ±{fmt(cycle_sd())} | cycles: {len(STATE.cycle_history)}")
 
-    log(f"📊 Cycle recorded | duration: {fmt(duration)} | avg: {fmt(state['avg_cycle_duration'])} | cycles: {len(state['cycle_history'])}")
+def cycle_sd():
+    return math.sqrt(STATE.cycle_variance) if STATE.cycle_variance else 0
 
 def predict_next_restock(depletion_time):
-    if state['avg_cycle_duration']:
-        return depletion_time + state['avg_cycle_duration']
+    if STATE.avg_cycle_duration:
+        return depletion_time + STATE.avg_cycle_duration
     return depletion_time + (2 * 60 * 60 * 1000)
 
-def validate_and_adjust(predicted, actual):
+def validate_prediction(predicted, actual):
+    # Log only: the cycle is fed to the Kalman filter once, by record_cycle()
     error = actual - predicted
-    error_min = error / (60 * 1000)
-
-    log(f"🎓 Validation: predicted={ts(predicted)} | actual={ts(actual)} | error={fmt(error)}")
-
-    if abs(error_min) > 5 and state['avg_cycle_duration']:
-        adjustment = error * 0.3
-        old_avg = state['avg_cycle_duration']
-        state['avg_cycle_duration'] += adjustment
-        log(f"⚙️ Adjusted avg cycle: {fmt(old_avg)} → {fmt(state['avg_cycle_duration'])}")
+    log(f"🎓 Validation: predicted={ts(predicted)} | actual={ts(actual)} | error={fmt(error)} | ±{fmt(cycle_sd())}")
 
 # ============================================================
 # DISCORD UI - TRAVEL BUTTON
@@ -120,121 +259,141 @@ class TravelView(discord.ui.View):
 # DATA
 # ============================================================
 
-async def get_prometheus():
+def _parse_stock(data, source, parse_restock, item_id=SHARK_FIN_ID):
+    haw = data.get('stocks', {}).get('haw', {})
+    by_id = {s.get('id'): s for s in haw.get('stocks', ())}
+    stock = by_id.get(item_id)
+    if not stock:
+        return None
+    return {
+        'quantity': stock['quantity'],
+        'cost': stock.get('cost', 0),
+        'next_restock': parse_iso(stock.get('nextRestock')) if parse_restock else None,
+        'source': source
+    }
+
+async def _fetch(name, url, parse_restock):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(PROMETHEUS_URL, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-                if resp.status == 200:
-                    data = await resp.json(content_type=None)
-                    haw = data.get('stocks', {}).get('haw', {})
-                    shark = next((s for s in haw.get('stocks', []) if s.get('id') == 1485), None)
-                    if shark:
-                        return {
-                            'quantity': shark['quantity'],
-                            'cost': shark.get('cost', 0),
-                            'next_restock': parse_iso(shark.get('nextRestock')),
-                            'source': 'Prometheus'
-                        }
+        async with SESSION.get(url) as resp:
+            if resp.status == 200:
+                return _parse_stock(orjson.loads(await resp.read()), name, parse_restock)
     except Exception as e:
-        log(f"Prometheus error: {e}")
+        log(f"{name} error: {e}")
     return None
 
-async def get_yata():
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(YATA_URL, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-                if resp.status == 200:
-                    data = await resp.json(content_type=None)
-                    haw = data.get('stocks', {}).get('haw', {})
-                    shark = next((s for s in haw.get('stocks', []) if s.get('id') == 1485), None)
-                    if shark:
-                        return {
-                            'quantity': shark['quantity'],
-                            'cost': shark.get('cost', 0),
-                            'next_restock': None,
-                            'source': 'YATA'
-                        }
-    except Exception as e:
-        log(f"YATA error: {e}")
+async def get_data():
+    # Query every source at once so a slow primary doesn't delay the
+    # fallbacks; the first source in SOURCES order with data wins.
+    fetches = [asyncio.create_task(_fetch(*src)) for src in SOURCES]
+    for i, task in enumerate(fetches):
+        data = await task
+        if data:
+            for other in fetches[i + 1:]:
+                other.cancel()
+            return data
+        if i + 1 < len(SOURCES):
+            log(f"{SOURCES[i][0]} unavailable, using {SOURCES[i + 1][0]}...")
     return None
 
-async def get_data():
-    data = await get_prometheus()
+async def _refresh():
+    global _last_data, _last_data_at
+    data = await get_data()
     if data:
-        return data
-    log("Prometheus unavailable, using YATA...")
-    return await get_yata()
+        _last_data = data
+        _last_data_at = now_ms()
+    return data
+
+async def get_data_swr():
+    # Give the refresh a few seconds; if upstream is stalling, serve the last
+    # good response (if it is at most one poll interval old) and leave the
+    # refresh running for the next tick.
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.create_task(_refresh())
+    try:
+        return await asyncio.wait_for(asyncio.shield(_refresh_task), FRESH_WAIT)
+    except asyncio.TimeoutError:
+        n = now_ms()
+        if _last_data and n - _last_data_at <= poll_interval(n) * 1000:
+            log(f"Upstream slow, serving cached {_last_data['source']} data ({fmt(n - _last_data_at)} old)")
+            return _last_data
+        return await _refresh_task
 
 # ============================================================
 # EMBEDS
 # ============================================================
 
-def embed_online():
-    e = discord.Embed(
-        title="🦈 Shark Fin Bot Online - Self-Calibrating",
-        description="Monitoring Hawaii shark fins via Prometheus.\nLearning cycle patterns for optimal timing!",
-        color=0x5865F2,
-        timestamp=datetime.now(timezone.utc)
-    )
-    e.add_field(name="✈️ Flight", value="1h 34m", inline=True)
-    e.add_field(name="🎯 Landing", value="2min AFTER restock", inline=True)
-    e.add_field(name="🔄 Check", value="Every 1min", inline=True)
+# Static fields, built once at import; only timestamps/ts() values vary per DM
+_ONLINE_FIELDS = (
+    ("✈️ Flight", "1h 34m", True),
+    ("🎯 Landing", "2min AFTER restock", True),
+    ("🔄 Check", f"Every {POLL_INTERVALS[0][1]}s–{MAX_POLL_SECONDS // 60}min", True),
+)
+_LANDING_FIELD = ("🛬 Landing", f"{LANDING_BUFFER} min AFTER restock", False)
+_TIMING_FIELD = ("⏱️ Timing", f"Land {LANDING_BUFFER}min after restock ✅", False)
+
+# Static title/description/colour per embed, fed to Embed.from_dict()
+_ONLINE_TEMPLATE = {
+    'title': "🦈 Shark Fin Bot Online - Self-Calibrating",
+    'description': "Monitoring Hawaii shark fins via Prometheus.\nLearning cycle patterns for optimal timing!",
+    'color': 0x5865F2,
+}
+_WARNING_TEMPLATE = {'description': "Get ready to fly to Hawaii!", 'color': 0xFFAA00}
+_DEPART_TEMPLATE = {'title': "✈️ FLY NOW TO HAWAII!", 'description': "**Buy your ticket immediately!**", 'color': 0x0099FF}
+_DEPLETION_TEMPLATE = {'title': "🔴 SHARK FINS DEPLETED", 'description': "Stock sold out! Learning cycle timing...", 'color': 0xFF4444}
+_RESTOCK_TEMPLATE = {'title': "🟢 SHARK FINS RESTOCKED!", 'color': 0x00CC44}
+
+def add_fields(e, *fields):
+    for name, value, inline in fields:
+        e.add_field(name=name, value=value, inline=inline)
+
+def new_embed(template, now=None):
+    e = discord.Embed.from_dict(template)
+    e.timestamp = now or discord.utils.utcnow()
+    return e
+
+def embed_online(now=None):
+    # Built fresh each call: Embed.copy() shares the field list with its source
+    e = new_embed(_ONLINE_TEMPLATE, now)
+    add_fields(e, *_ONLINE_FIELDS)
     return e
 
-def embed_warning(dept, restock):
-    e = discord.Embed(
-        title="⏰ DEPART IN 10 MINUTES",
-        description="Get ready to fly to Hawaii!",
-        color=0xFFAA00,
-        timestamp=datetime.now(timezone.utc)
-    )
+def embed_warning(dept, restock, left, now=None):
+    e = new_embed(_WARNING_TEMPLATE, now)
+    e.title = f"⏰ DEPART IN {fmt(left)}"
     e.add_field(name="✈️ Depart At", value=ts(dept), inline=False)
     e.add_field(name="🎯 Restock At", value=ts(restock), inline=False)
-    e.add_field(name="🛬 Landing", value=f"{LANDING_BUFFER} min AFTER restock", inline=False)
+    add_fields(e, _LANDING_FIELD)
     return e
 
-def embed_depart(dept, restock):
-    landing = dept + (FLIGHT_MINUTES * 60 * 1000)
-    e = discord.Embed(
-        title="✈️ FLY NOW TO HAWAII!",
-        description="**Buy your ticket immediately!**",
-        color=0x0099FF,
-        timestamp=datetime.now(timezone.utc)
-    )
+def embed_depart(dept, restock, now=None):
+    landing = dept + FLIGHT_MS
+    e = new_embed(_DEPART_TEMPLATE, now)
     e.add_field(name="🛬 Landing At", value=ts(landing), inline=False)
     e.add_field(name="🎯 Restock At", value=ts(restock), inline=False)
-    e.add_field(name="⏱️ Timing", value=f"Land {LANDING_BUFFER}min after restock ✅", inline=False)
+    add_fields(e, _TIMING_FIELD)
     return e
 
-def embed_depletion(cost):
-    e = discord.Embed(
-        title="🔴 SHARK FINS DEPLETED",
-        description="Stock sold out! Learning cycle timing...",
-        color=0xFF4444,
-        timestamp=datetime.now(timezone.utc)
-    )
+def embed_depletion(cost, restock, now=None):
+    e = new_embed(_DEPLETION_TEMPLATE, now)
     e.add_field(name="💰 Last Price", value=f"${cost:,}", inline=True)
-    cycles = len(state['cycle_history'])
+    cycles = len(STATE.cycle_history)
     if cycles > 0:
         e.add_field(name="📊 Cycles Learned", value=str(cycles), inline=True)
-        e.add_field(name="⏱️ Avg Duration", value=fmt(state['avg_cycle_duration']), inline=True)
-    if state['predicted_restock']:
-        e.add_field(name="🎯 Predicted Restock", value=ts(state['predicted_restock']), inline=False)
-        dept = calc_depart_time(state['predicted_restock'])
+        e.add_field(name="⏱️ Avg Duration", value=f"{fmt(STATE.avg_cycle_duration)} ±{fmt(cycle_sd())}", inline=True)
+    if restock:
+        e.add_field(name="🎯 Predicted Restock", value=ts(restock), inline=False)
+        dept = calc_depart_time(restock)
         e.add_field(name="✈️ Depart At", value=ts(dept), inline=False)
     else:
         e.add_field(name="⏳ Status", value="Watching this cycle to learn timing", inline=False)
     return e
 
-def embed_restock(qty, cost):
-    e = discord.Embed(
-        title="🟢 SHARK FINS RESTOCKED!",
-        description=f"**{qty:,} items** available - buy now!",
-        color=0x00CC44,
-        timestamp=datetime.now(timezone.utc)
-    )
+def embed_restock(qty, cost, now=None):
+    e = new_embed(_RESTOCK_TEMPLATE, now)
+    e.description = f"**{qty:,} items** available - buy now!"
     e.add_field(name="💰 Price", value=f"${cost:,}", inline=True)
-    cycles = len(state['cycle_history'])
+    cycles = len(STATE.cycle_history)
     if cycles > 0:
         e.add_field(name="📊 Learned Cycles", value=str(cycles), inline=True)
         conf = "🟢 HIGH" if cycles >= 3 else "🟡 LEARNING"
@@ -245,86 +404,173 @@ def embed_restock(qty, cost):
 # BOT
 # ============================================================
 
+class SharkBot(discord.Client):
+    async def close(self):
+        if SESSION is not None and not SESSION.closed:
+            await SESSION.close()
+        await super().close()
+
 intents = discord.Intents.default()
-bot = discord.Client(intents=intents)
+bot = SharkBot(intents=intents)
 
 async def dm(embed, view=None):
-    user = await bot.fetch_user(YOUR_DISCORD_ID)
-    await user.send(embed=embed, view=view)
+    global DM_CHANNEL
+    if DM_CHANNEL is None:
+        user = await bot.fetch_user(YOUR_DISCORD_ID)
+        DM_CHANNEL = await user.create_dm()
+    await DM_CHANNEL.send(embed=embed, view=view)
+
+def _is_transient(e):
+    if isinstance(e, discord.HTTPException):
+        return e.status >= 500
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+async def dm_worker():
+    while True:
+        embed, view = await _dm_queue.get()
+        for attempt in range(DM_RETRIES + 1):
+            try:
+                await dm(embed, view)
+                break
+            except Exception as e:
+                if attempt == DM_RETRIES or not _is_transient(e):
+                    log(f"DM error: {e}")
+                    break
+                delay = 2 ** (attempt + 1)
+                log(f"DM error: {e} | retrying in {delay}s")
+                await asyncio.sleep(delay)
+
+def notify(embed, view=None):
+    _dm_queue.put_nowait((embed, view))
 
 @bot.event
 async def on_ready():
+    global SESSION, _dm_worker_task, _monitor_task
     log(f"🦈 Shark Fin Bot online as {bot.user}")
-    await dm(embed_online())
-    monitor.start()
+    if SESSION is None or SESSION.closed:
+        SESSION = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=10),
+            connector=aiohttp.TCPConnector(
+                limit=4,
+                limit_per_host=2,
+                use_dns_cache=True,
+                ttl_dns_cache=3600,
+                keepalive_timeout=75,
+                enable_cleanup_closed=True
+            )
+        )
+    if _dm_worker_task is None:
+        _dm_worker_task = asyncio.create_task(dm_worker())
+    if _monitor_task is None:
+        _monitor_task = asyncio.create_task(monitor_forever())
+    notify(embed_online())
+
+def poll_interval(n):
+    # Only back off while waiting on a known restock time; depletion and
+    # unpredicted restocks are timed by the poll, so keep those at 1min.
+    restock = STATE.predicted_restock
+    if not restock or STATE.quantity != 0:
+        return POLL_SECONDS
+    for minutes, seconds in POLL_INTERVALS:
+        if restock - n < minutes * 60 * 1000:
+            return seconds
+    return MAX_POLL_SECONDS
+
+def next_poll_delay():
+    # Wake for the next warn/depart/restock deadline, but never sleep past
+    # the current poll interval so depletions and restocks are still noticed.
+    n = now_ms()
+    interval = poll_interval(n)
+    deadlines = [n + interval * 1000]
+    restock = STATE.predicted_restock
+    if restock and STATE.quantity == 0:
+        dept = calc_depart_time(restock)
+        deadlines += [t for t in (calc_warn_time(restock, dept), dept, restock) if t > n]
+    delay = (min(deadlines) - n) / 1000
+    return min(max(delay, MIN_POLL_SECONDS), interval)
+
+async def monitor_forever():
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        try:
+            await monitor()
+        except Exception as e:
+            log(f"Monitor error: {e}")
+        await asyncio.sleep(next_poll_delay())
 
-@tasks.loop(minutes=CHECK_INTERVAL)
 async def monitor():
     n = now_ms()
-    data = await get_data()
+    now_utc = datetime.fromtimestamp(n / 1000, timezone.utc)
+    data = await get_data_swr()
     if not data:
         log("Both sources unavailable")
         return
 
     qty = data['quantity']
-    prev_qty = state['quantity']
-    state['quantity'] = qty
-
-    if data['next_restock']:
-        if data['next_restock'] != state['prometheus_restock']:
-            state['prometheus_restock'] = data['next_restock']
-            log(f"🔍 Prometheus nextRestock: {ts(data['next_restock'])}")
-
-            if state['predicted_restock']:
-                validate_and_adjust(state['predicted_restock'], data['next_restock'])
-
-            state['predicted_restock'] = data['next_restock']
-            state['warning_sent'] = False
-            state['depart_sent'] = False
-
-    if prev_qty is not None and prev_qty > 0 and qty == 0:
-        state['last_depletion'] = n
-        state['predicted_restock'] = predict_next_restock(n)
-        state['warning_sent'] = False
-        state['depart_sent'] = False
-        await dm(embed_depletion(data['cost']))
-        log(f"🔴 Depletion | predicted next: {ts(state['predicted_restock'])}")
-
-    elif prev_qty == 0 and qty > 0:
-        state['last_restock'] = n
-        if state['last_depletion']:
-            record_cycle(state['last_depletion'], n)
-        await dm(embed_restock(qty, data['cost']))
-        log(f"🟢 Restock")
-        state['predicted_restock'] = None
-        state['prometheus_restock'] = None
-
-    if state['predicted_restock'] and qty == 0:
-        dept = calc_depart_time(state['predicted_restock'])
-        warn = dept - (WARNING_MINUTES * 60 * 1000)
-
-        if not state['warning_sent'] and warn <= n < dept:
-            await dm(embed_warning(dept, state['predicted_restock']))
-            state['warning_sent'] = True
-            log("⏰ Warning sent")
-
-        if not state['depart_sent'] and dept <= n < state['predicted_restock']:
-            await dm(
-                embed_depart(dept, state['predicted_restock']),
-                view=TravelView()
-            )
-            state['depart_sent'] = True
-            log("✈️ Depart sent")
+    prev_qty = STATE.quantity
+    STATE.quantity = qty
 
-    if state['predicted_restock'] and qty == 0:
-        dept = calc_depart_time(state['predicted_restock'])
-        log(f"SOLD OUT | restock in {fmt(state['predicted_restock']-n)} | depart in {fmt(dept-n)} | cycles={len(state['cycle_history'])}")
-    else:
-        log(f"qty={qty} | ${data['cost']:,}")
+    restock = STATE.predicted_restock
+    warned = STATE.warning_sent
+    departed = STATE.depart_sent
 
-@monitor.before_loop
-async def before_monitor():
-    await bot.wait_until_ready()
+    try:
+        next_restock = data['next_restock']
+        if next_restock and next_restock != STATE.prometheus_restock:
+            STATE.prometheus_restock = next_restock
+            log(f"🔍 Prometheus nextRestock: {ts(next_restock)}")
+
+            if restock:
+                validate_prediction(restock, next_restock)
+
+            restock = next_restock
+            warned = departed = False
+
+        if prev_qty is not None and prev_qty > 0 and qty == 0:
+            STATE.last_depletion = n
+            restock = predict_next_restock(n)
+            warned = departed = False
+            notify(embed_depletion(data['cost'], restock, now=now_utc))
+            log(f"🔴 Depletion | predicted next: {ts(restock)}")
+
+        elif prev_qty == 0 and qty > 0:
+            STATE.last_restock = n
+            if STATE.last_depletion:
+                record_cycle(STATE.last_depletion, n)
+                STATE.last_depletion = None
+            notify(embed_restock(qty, data['cost'], now=now_utc))
+            log(f"🟢 Restock")
+            restock = None
+            STATE.prometheus_restock = None
+
+        sold_out = bool(restock) and qty == 0
+        dept = calc_depart_time(restock) if sold_out else None
+
+        if sold_out:
+            warn = calc_warn_time(restock, dept)
+
+            if not warned and warn <= n < dept:
+                notify(embed_warning(dept, restock, dept - n, now=now_utc))
+                warned = True
+                log("⏰ Warning sent")
+
+            if not departed and dept <= n < restock:
+                notify(
+                    embed_depart(dept, restock, now=now_utc),
+                    view=TravelView()
+                )
+                departed = True
+                log("✈️ Depart sent")
+    finally:
+        STATE.predicted_restock = restock
+        STATE.warning_sent = warned
+        STATE.depart_sent = departed
+        await save_state()
+
+    if sold_out:
+        logger.debug(f"SOLD OUT | restock in {fmt(restock-n)} | depart in {fmt(dept-n)} | cycles={len(STATE.cycle_history)}")
+    else:
+        logger.debug(f"qty={qty} | ${data['cost']:,}")
 
 if __name__ == '__main__':
     if not DISCORD_TOKEN:
@@ -333,4 +579,11 @@ if __name__ == '__main__':
     if not YOUR_DISCORD_ID:
         print("DISCORD_USER_ID not set!")
         exit(1)
-    bot.run(DISCORD_TOKEN)
+    log_listener.start()
+    try:
+        load_state()
+        if uvloop:
+            uvloop.install()
+        bot.run(DISCORD_TOKEN, log_handler=None)
+    finally:
+        log_listener.stop()